@@ -1,6 +1,7 @@
 import re
 import time
 import json
+import numpy as np
 import matplotlib.pyplot as plt
 from openai import OpenAI
 import os
@@ -28,33 +29,37 @@ ground_truth = [
 stopwords = ['은','는','이','가','을','를','에','의','도','으로','로',
              '그리고','하지만','말고','위주','좋은데','에서','부터','까지','좀','은데','에는']
 
-def extract_keywords_simple(text):
-    tokens = re.findall(r"[가-힣]+", text)
-    return [w for w in tokens if w not in stopwords and len(w) > 1]
-
-def extract_excluded_simple(text):
-    excluded = []
-    tokens = text.split()
-    for i, word in enumerate(tokens):
-        if any(kw in word for kw in ['말고', '빼줘', '싫', '제외']):
-            if i > 0:
-                excluded.append(re.sub(r'[^가-힣]', '', tokens[i-1]))
-    return excluded
-def extract_keywords_ai(text):
-    prompt = f"""
-    다음 문장에서 핵심 키워드와 제외 키워드를 JSON으로 추출해줘.
-    반드시 JSON만 출력해. 설명, 문장, 따옴표 밖 텍스트는 금지.
-    예시:
-    {{
-      "keywords": ["무료","강연","실내"],
-      "excluded": ["야외","어린이"]
-    }}
-    문장: "{text}"
-    """
+_HANGUL_RE = re.compile(r"[가-힣]+")
+_STOPWORDS = frozenset(stopwords)
+_EXCL_MARKERS = frozenset(['말고', '빼줘', '싫', '제외'])
+
+def extract_all(text):
+    # 공백 토큰을 한 번만 훑으면서 키워드와 제외 키워드를 같이 뽑음
+    keywords, excluded = [], []
+    prev = None
+    for word in text.split():
+        runs = _HANGUL_RE.findall(word)
+        keywords.extend(w for w in runs if w not in _STOPWORDS and len(w) > 1)
+        if prev is not None and any(kw in word for kw in _EXCL_MARKERS):
+            excluded.append(prev)
+        prev = ''.join(runs)
+    return keywords, excluded
+# 지시문 + 예시는 고정된 system 메시지로 두고 문장만 user 메시지로 보냄 (매 호출 앞부분이 똑같음)
+KEYWORD_SYSTEM_PROMPT = """
+다음 문장에서 핵심 키워드와 제외 키워드를 JSON으로 추출해줘.
+반드시 JSON만 출력해. 설명, 문장, 따옴표 밖 텍스트는 금지.
+예시:
+{
+  "keywords": ["무료","강연","실내"],
+  "excluded": ["야외","어린이"]
+}
+"""
+KEYWORD_SYSTEM_MESSAGE = {"role": "system", "content": KEYWORD_SYSTEM_PROMPT}
 
+def extract_keywords_ai(text):
     response = client.chat.completions.create(
         model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
+        messages=[KEYWORD_SYSTEM_MESSAGE, {"role": "user", "content": f'문장: "{text}"'}],
     )
     content = response.choices[0].message.content.strip()
 
@@ -72,20 +77,24 @@ def extract_keywords_ai(text):
     
     return {"keywords": [], "excluded": []}
 
-def jaccard_similarity(set1, set2):
-    if not set1 and not set2:
-        return 1.0
-    intersection = len(set(set1) & set(set2))
-    union = len(set(set1) | set(set2))
-    return intersection / union if union else 0
+def to_matrix(word_lists, vocab_index):
+    matrix = np.zeros((len(word_lists), len(vocab_index)), dtype=bool)
+    for row, words in enumerate(word_lists):
+        matrix[row, [vocab_index[w] for w in words]] = True
+    return matrix
+
+def jaccard_similarity(a, b):
+    # 행 단위 자카드 유사도, 둘 다 비어 있으면 1.0
+    intersection = (a & b).sum(axis=1)
+    union = (a | b).sum(axis=1)
+    return np.divide(intersection, union, out=np.ones(len(a)), where=union > 0)
 
 rule_results, ai_results = [], []
 rule_times, ai_times = [], []
 
 for sentence in sentences:
     start = time.time()
-    kw_rule = extract_keywords_simple(sentence)
-    ex_rule = extract_excluded_simple(sentence)
+    kw_rule, ex_rule = extract_all(sentence)
     rule_times.append(time.time() - start)
     rule_results.append({"keywords": kw_rule, "excluded": ex_rule})
 
@@ -96,23 +105,19 @@ for sentence in sentences:
     ai_results.append(ai_data)
 
 
-rule_acc, ai_acc = [], []
+vocab = sorted({w for r in ground_truth + rule_results + ai_results for w in r["keywords"] + r["excluded"]})
+vocab_index = {w: i for i, w in enumerate(vocab)}
 
-for i in range(len(sentences)):
-    gt_kw = set(ground_truth[i]["keywords"])
-    gt_ex = set(ground_truth[i]["excluded"])
+gt_kw = to_matrix([r["keywords"] for r in ground_truth], vocab_index)
+gt_ex = to_matrix([r["excluded"] for r in ground_truth], vocab_index)
 
-  
-    r_kw = set(rule_results[i]["keywords"])
-    r_ex = set(rule_results[i]["excluded"])
-    rule_score = (jaccard_similarity(gt_kw, r_kw) + jaccard_similarity(gt_ex, r_ex)) / 2
-    rule_acc.append(rule_score)
+r_kw = to_matrix([r["keywords"] for r in rule_results], vocab_index)
+r_ex = to_matrix([r["excluded"] for r in rule_results], vocab_index)
+rule_acc = ((jaccard_similarity(gt_kw, r_kw) + jaccard_similarity(gt_ex, r_ex)) / 2).tolist()
 
-  
-    a_kw = set(ai_results[i]["keywords"])
-    a_ex = set(ai_results[i]["excluded"])
-    ai_score = (jaccard_similarity(gt_kw, a_kw) + jaccard_similarity(gt_ex, a_ex)) / 2
-    ai_acc.append(ai_score)
+a_kw = to_matrix([r["keywords"] for r in ai_results], vocab_index)
+a_ex = to_matrix([r["excluded"] for r in ai_results], vocab_index)
+ai_acc = ((jaccard_similarity(gt_kw, a_kw) + jaccard_similarity(gt_ex, a_ex)) / 2).tolist()
 
 
 for i, s in enumerate(sentences):
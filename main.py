@@ -1,22 +1,34 @@
-import json
+import io
+import mmap
 import os
-from typing import List, Optional, Dict
+import re
+import tempfile
+from typing import List, Optional, Dict, Tuple
+from collections import Counter, OrderedDict, defaultdict, deque
+from itertools import islice
+from functools import lru_cache
 import asyncio
-import aiofiles
+import hashlib
+import time
 import numpy as np
 import faiss
+import orjson
+from aiolimiter import AsyncLimiter
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse,JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse,JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from openai import AsyncOpenAI
+from openai import APIConnectionError, AsyncOpenAI, DefaultAsyncHttpxClient, InternalServerError, RateLimitError
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from pathlib import Path
+try:
+    import fcntl #워커 여러 개가 임베딩 캐시를 같이 만들지 않게 파일 잠금 (Windows엔 없음)
+except ImportError:
+    fcntl = None
 
 # fastapi 웹 서버
 # Jinja2Templates, StaticFiles: HTML, 정적 파일(css, js) 처리
-# aiofiles: 비동기 파일 입출력
 # numpy / faiss: 벡터 검색용 (이벤트 임베딩 처리).
 # openai.AsyncOpenAI: OpenAI API 비동기 호출
 # dotenv: .env 파일에서 환경 변수 읽기.
@@ -42,10 +54,37 @@ templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 EVENTS_JSON_PATH = Path("events.json")
 EVENTS_EN_JSON_PATH = Path("events_en.json")
-EMBEDDINGS_CACHE_PATH = Path("embeddings_cache.json")
+EMBEDDINGS_CACHE_PATH = Path("embeddings_cache.npy") #float16 바이너리 임베딩 캐시
+LEGACY_EMBEDDINGS_CACHE_PATH = Path("embeddings_cache.json") #이전 JSON 캐시 (있으면 마이그레이션)
+EMBEDDINGS_KEYS_PATH = Path("embeddings_cache_keys.json") #캐시 각 행의 키 (모델 + 텍스트 해시)
+FAISS_INDEX_PATH = Path("events.faiss") #학습/추가까지 끝난 FAISS 인덱스 파일
+VECTOR_CACHE_LOCK_PATH = Path("embeddings_cache.lock") #캐시 확인 ~ 저장까지 한 워커만 하도록 잡는 잠금 파일
+EVENTS_LOAD_TIMEOUT = 10 #이벤트 파일 하나 읽는 최대 시간 (초)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_CONCURRENCY = 8 #임베딩 배치 동시 요청 수
+EMBEDDING_BATCH_WINDOW = 0.02 #질문 임베딩 요청을 모으는 시간 (초)
+EMBEDDING_BATCH_MAX = 64 #한 번에 묶는 최대 질문 수
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.25")) #가장 비슷한 이벤트의 코사인 유사도도 이보다 낮으면 관련 이벤트 없음으로 봄
+HNSW_THRESHOLD = 10000 #이벤트 수가 이보다 많으면 HNSW 인덱스 사용
+HNSW_M = 32 #HNSW 그래프의 노드당 연결 수
+OPENAI_RPM = int(os.getenv("OAI_RPM", "500")) #모델별 분당 최대 요청 수 (OpenAI 계정 한도에 맞춰 설정)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32")) #워커 하나에서 동시에 기다리는 최대 OpenAI 요청 수
 
 # OPENAI_API_KEY가 없으면 None으로 설정
-openai_client: Optional[AsyncOpenAI] = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# HTTP/2로 채팅 / 임베딩 요청을 연결 하나에 같이 실어 보냄 (요청마다 연결/핸드셰이크 안 함)
+# SDK 자체 재시도는 끔 -> 재시도는 openai_request 한 곳에서만 (SDK 재시도 x 우리 재시도로 호출 수가 곱해지지 않게)
+openai_client: Optional[AsyncOpenAI] = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(http2=True),
+    max_retries=0,
+) if OPENAI_API_KEY else None
+
+# OpenAI 요청 속도 제한 (토큰 버킷, 한도가 남아 있으면 바로 통과하고 다 썼을 때만 대기)
+# rate limit은 모델별이라 채팅 / 임베딩 따로 둠
+chat_rate_limiter = AsyncLimiter(OPENAI_RPM, 60)
+embedding_rate_limiter = AsyncLimiter(OPENAI_RPM, 60)
+# 동시에 떠 있는 OpenAI 요청 수 제한 (채팅 / 임베딩 / 번역 공통, 몰릴 때 연결/메모리 폭주 방지)
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
 
 # =========================
 # In-memory cache
@@ -54,315 +93,845 @@ events_data: List[dict] = [] #한국어 이벤트 데이터
 events_data_en: List[dict] = [] #영어 이벤트 데이터
 event_embeddings: Optional[np.ndarray] = None #모든 이벤트 임베딩 행렬
 faiss_index: Optional[faiss.Index] = None #FAISS 검색 인덱스
+event_compact_json: List[str] = [] #프롬프트에 넣을 이벤트 요약 JSON (events_data와 같은 순서)
+event_texts: List[str] = [] #임베딩용 이벤트 텍스트 (events_data와 같은 순서)
+event_periods: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None #events_data 기간 (형식 정상 여부, 시작일, 종료일 ordinal) - 상태 갱신 때 다시 파싱 안 함
+event_state_task: Optional[asyncio.Task] = None #자정마다 상태를 갱신하는 백그라운드 태스크
+event_token_index: Dict[str, List[int]] = {} #토큰 -> 이벤트 인덱스 (임베딩 검색을 못 할 때 쓰는 키워드 검색용)
+events_response: Optional[Tuple[bytes, str]] = None #/events 응답 (JSON 바이트, ETag)
+events_en_response: Optional[Tuple[bytes, str]] = None #/events_en 응답 (JSON 바이트, ETag)
+gpu_resources = None #FAISS GPU 리소스 (GPU 쓸 때 한 번만 만들어서 재사용)
+embedding_queue: Optional[asyncio.Queue] = None #get_embedding 요청 큐 (text, future)
+embedding_batcher_task: Optional[asyncio.Task] = None #큐를 비우는 백그라운드 태스크
+
+# 질문 임베딩 LRU 캐시 (같은 질문이면 OpenAI 호출 생략)
+query_embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+QUERY_CACHE_SIZE = 512 #캐시에 보관할 최대 질문 수
+query_embedding_inflight: Dict[str, "asyncio.Task"] = {} #임베딩 요청 중인 질문 (캐시 키 -> 작업)
+
+# 의미 기반 응답 캐시 (이전 대화 없는 질문만, 거의 같은 뜻의 질문이면 저장된 답변 재사용)
+# 고정 크기 칸: 질문 벡터 행렬 + 같은 순서의 답변/저장 시각/날짜/마지막 사용 시각
+# 꽉 차면 가장 오래 안 쓴 칸(LRU)부터 덮어씀
+RESPONSE_CACHE_SIZE = 256 #캐시에 보관할 최대 답변 수
+RESPONSE_CACHE_THRESHOLD = 0.95 #코사인 유사도가 이 이상이면 같은 질문으로 봄
+RESPONSE_CACHE_TTL = 3600 #초 단위, 답변 유효 시간
+response_cache_vectors: Optional[np.ndarray] = None #정규화된 질문 벡터 (RESPONSE_CACHE_SIZE x d)
+response_cache_created = np.zeros(RESPONSE_CACHE_SIZE) #저장 시각 (time.monotonic)
+response_cache_used = np.zeros(RESPONSE_CACHE_SIZE) #마지막으로 저장/재사용한 시각 (time.monotonic, LRU 교체용)
+response_cache_days = np.zeros(RESPONSE_CACHE_SIZE, dtype=np.int64) #저장한 날짜 (date.toordinal, 상태가 날짜에 따라 바뀌므로)
+response_cache_entries: List[Optional[dict]] = [None] * RESPONSE_CACHE_SIZE
+response_cache_next = 0 #저장한 총 개수 (RESPONSE_CACHE_SIZE보다 작으면 다음 빈 칸)
+
+# 오늘 날짜 캐시 (날짜는 하루에 한 번 바뀌므로 매 요청마다 datetime.now() 안 함)
+_TODAY_CACHE = {"date": None, "str": None, "checked_at": 0.0}
+TODAY_CACHE_TTL = 60 #초 단위, 이 시간마다 날짜 다시 확인
 
 # 세션별 대화 히스토리 저장용 메모리
-conversation_memory: Dict[str, List[Dict[str, str]]] = {} 
+# deque(maxlen)라서 오래된 기록은 append할 때 자동으로 밀려남
+# 세션은 LRU 순서로 관리하고 MAX_SESSIONS 넘으면 가장 오래 안 쓴 세션부터 삭제
+conversation_memory: "OrderedDict[str, deque]" = OrderedDict()
 MAX_MEMORY = 10 #세션당 최대 대화 기록 수
-async def translate_event_with_openai(event: dict) -> dict:
-    """행사 정보를 OpenAI를 사용해 영어로 번역"""
-    if not openai_client:
-        return {}
+MAX_HISTORY_MESSAGES = 16 #세션당 저장하는 최대 메시지 수 (user + assistant)
+MAX_SESSIONS = 10000 #메모리에 유지하는 최대 세션 수
+MAX_MESSAGE_CHARS = 2000 #프롬프트 / 임베딩에 넣는 메시지 하나의 최대 글자 수 (너무 긴 입력으로 컨텍스트 한도 넘는 것 방지)
+MAX_PROMPT_CHARS = 100000 #채팅 프롬프트 전체 최대 글자 수 (한글은 대략 1글자 = 1토큰 이상이라 128K 토큰 컨텍스트보다 여유 있게)
+TRANSLATE_CONCURRENCY = 8 #번역 동시 요청 수
+OPENAI_MAX_RETRIES = 3 #429 / 일시적인 오류 시 재시도 횟수 (백그라운드 작업용)
+OPENAI_RETRY_ERRORS = (RateLimitError, APIConnectionError, InternalServerError) #다시 보내면 될 수 있는 오류
+
+
+def retry_after_seconds(error: Exception, attempt: int) -> float:
+    #429 응답의 Retry-After 헤더(초) 읽기, 없으면 지수 백오프
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return 2 ** attempt
+
+
+async def openai_request(limiter: AsyncLimiter, create, max_retries: int = OPENAI_MAX_RETRIES, **kwargs):
+    #OpenAI API 호출 공통 처리: 속도 제한 + 429나 일시적인 오류가 나면 Retry-After 만큼만 쉬고 다시 시도
+    #(쉬는 건 이 호출 하나뿐이고 다른 요청은 계속 진행)
+    #max_retries : 사용자가 기다리는 요청은 0으로 넘겨서 바로 실패 -> 호출하는 쪽 대체 경로로
+    for attempt in range(max_retries + 1):
+        try:
+            async with openai_semaphore, limiter:
+                return await create(**kwargs)
+        except OPENAI_RETRY_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(retry_after_seconds(e, attempt))
+
+
+TRANSLATED_FIELDS = ("title_en", "place_en", "host_en", "period_en")
+TRANSLATE_SOURCE_FIELDS = ("title", "place", "host", "period") #번역할 필드 (state는 번역 X)
+
+
+def translation_source_hash(event: dict) -> str:
+    #번역한 한국어 원문 필드의 해시 (번역에 같이 저장해서 원문이 바뀌었는지 확인)
+    source = orjson.dumps([event.get(k) or "" for k in TRANSLATE_SOURCE_FIELDS])
+    return hashlib.blake2b(source, digest_size=8).hexdigest()
 
-    # 번역할 필드
-    title = event.get("title") or ""
-    place = event.get("place") or ""
-    host = event.get("host") or ""
-    period = event.get("period") or ""  # 번역 대상에 포함
-    # state는 번역 X
 
-    if not title and not place and not host and not period:
-        return {"id": event.get("id")}
+def empty_translation(event: dict) -> dict:
+    #번역 못 한 행사용 빈 번역 (항상 같은 모양으로 반환해서 호출하는 쪽에서 거를 필요 없게)
+    return {"id": event.get("id"), **{k: "" for k in TRANSLATED_FIELDS}, "source_hash": translation_source_hash(event)}
 
-    system_prompt = """
+
+def is_translated(event: dict) -> bool:
+    #번역 필드가 다 있고 제목 번역이 비어있지 않으면 이미 번역된 것
+    #번역 실패하면 전부 빈 문자열로 저장되니까 그런 건 다시 번역함
+    return bool(event.get("title_en")) and all(k in event for k in TRANSLATED_FIELDS)
+
+
+TRANSLATE_BATCH_SIZE = 10 #한 번의 API 호출로 번역하는 행사 수
+
+TRANSLATE_SYSTEM_PROMPT = """
 You are a helpful translation assistant.
-Translate the following JSON values from Korean to English.
-- Keep the JSON structure.
+Translate the JSON values of every item from Korean to English.
+- The input is {"items": [{"id", "title", "place", "host", "period"}, ...]}.
+- Return {"items": [...]} with exactly one item per input item, keeping each id and the field names unchanged.
 - Provide only the translated JSON object, without any additional text or explanations.
 - If a field is empty or missing, keep it as an empty string.
 """
-    user_content = json.dumps({
-        "title": title,
-        "place": place,
-        "host": host,
-        "period": period
-    }, ensure_ascii=False)
-
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_content}
-    ]
 
-    try:
-        resp = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=0.1,
-        )
-        translated_content = json.loads(resp.choices[0].message.content)
-        return {
-            "id": event.get("id"),
-            "title_en": translated_content.get("title", ""),
-            "place_en": translated_content.get("place", ""),
-            "host_en": translated_content.get("host", ""),
-            "period_en": translated_content.get("period", "")
-        }
-    except Exception as e:
-        print(f"Error translating event ID {event.get('id')}: {e}")
-        return {
-            "id": event.get("id"),
-            "title_en": "",
-            "place_en": "",
-            "host_en": "",
-            "period_en": ""
-        }
+
+async def translate_events_batch(events: List[dict]) -> List[dict]:
+    """행사 여러 개를 한 번의 OpenAI 호출로 영어로 번역 (입력 순서대로 행사마다 번역 하나씩 반환)"""
+    translations = {}
+    items = []
+    for event in events:
+        if is_translated(event): #이미 번역된 행사는 API에 안 보냄
+            translations[str(event.get("id"))] = {"id": event.get("id"), **{k: event[k] for k in TRANSLATED_FIELDS}, "source_hash": event.get("source_hash")}
+            continue
+        item = {"id": event.get("id"), **{k: event.get(k) or "" for k in TRANSLATE_SOURCE_FIELDS}}
+        if any(item[k] for k in TRANSLATE_SOURCE_FIELDS): #번역할 게 있는 행사만
+            items.append(item)
+
+    if items and openai_client:
+        messages = [
+            {"role": "system", "content": TRANSLATE_SYSTEM_PROMPT},
+            {"role": "user", "content": orjson.dumps({"items": items}).decode()}
+        ]
+        pending = {str(item["id"]): item["id"] for item in items}
+        source_hashes = {str(item["id"]): translation_source_hash(item) for item in items}
+        try:
+            resp = await openai_request(
+                chat_rate_limiter,
+                openai_client.chat.completions.create,
+                model="gpt-4o-mini",
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.1,
+            )
+            translated_content = orjson.loads(resp.choices[0].message.content)
+            for translated in translated_content.get("items", []):
+                # 모델이 id를 문자열로 돌려줄 수도 있어서 문자열로 맞춰서 비교, 모르는 id는 무시
+                if not isinstance(translated, dict) or str(translated.get("id")) not in pending:
+                    continue
+                event_id = pending[str(translated.get("id"))]
+                translations[str(event_id)] = {
+                    "id": event_id,
+                    "title_en": translated.get("title", ""),
+                    "place_en": translated.get("place", ""),
+                    "host_en": translated.get("host", ""),
+                    "period_en": translated.get("period", ""),
+                    "source_hash": source_hashes[str(event_id)],
+                }
+        except Exception as e:
+            print(f"Error translating event IDs {list(pending.values())}: {e}")
+
+    # 응답에서 빠진 행사 / 번역할 게 없던 행사는 빈 번역 (다음 실행 때 다시 시도)
+    return [translations.get(str(event.get("id"))) or empty_translation(event) for event in events]
 
 
 @app.post("/api/translate-events")
 async def api_translate_events():
+    global events_data_en
     if not openai_client:
         return JSONResponse(status_code=400, content={"message": "OpenAI API key is not configured."})
 
     print("Starting event translation...")
 
-    translated_events = []
-
-    batch_size = 10  # 한 번에 10개씩 번역
-    for i in range(0, len(events_data), batch_size):
-        batch = events_data[i:i+batch_size]
-        tasks = [translate_event_with_openai(event) for event in batch]
-        results = await asyncio.gather(*tasks)
-
-        # 성공한 것만 추가
-        translated_events.extend([r for r in results if r and r.get("id") is not None])
-
-        print(f"Translated batch {i//batch_size + 1} ({len(translated_events)}/{len(events_data)})")
-        await asyncio.sleep(1.5)  # rate limit 방지 대기
+    # 고정 대기 없이 세마포어로 동시 요청 수만 제한 (끝나는 대로 다음 요청이 들어감)
+    # rate limit은 translate_events_batch에서 429가 났을 때만 Retry-After 보고 대기
+    semaphore = asyncio.Semaphore(TRANSLATE_CONCURRENCY)
+
+    async def bounded(batch: List[dict]) -> List[dict]:
+        async with semaphore:
+            return await translate_events_batch(batch)
+
+    # 이전에 저장된 번역(events_en.json)이 있는 행사는 그걸 넘겨서 다시 번역하지 않음
+    # id(위치)만 같고 한국어 원문이 바뀐 행사는 원문 해시가 달라서 다시 번역
+    existing = {e.get("id"): e for e in events_data_en if is_translated(e)}
+    todo = []
+    for event in events_data:
+        saved = existing.get(event["id"])
+        todo.append(saved if saved and saved.get("source_hash") == translation_source_hash(event) else event)
+    print(f"{sum(1 for event in todo if 'title_en' in event)} events already translated")
+
+    # TRANSLATE_BATCH_SIZE개씩 한 번의 호출로 번역 (시스템 프롬프트도 배치당 한 번만 보냄)
+    # translate_events_batch는 항상 행사마다 id + 번역 필드를 반환하므로 결과를 그대로 저장
+    results = await asyncio.gather(*(
+        bounded(todo[i:i + TRANSLATE_BATCH_SIZE]) for i in range(0, len(todo), TRANSLATE_BATCH_SIZE)
+    ))
+    translated_events = [translation for batch in results for translation in batch]
+    print(f"Translated {len(translated_events)}/{len(events_data)} events")
 
     # 저장
-    async with aiofiles.open(EVENTS_EN_JSON_PATH, mode="w", encoding="utf-8") as f:
-        await f.write(json.dumps(translated_events, indent=2, ensure_ascii=False))
+    # orjson은 한글을 그대로 UTF-8 바이트로 직렬화 (ensure_ascii=False와 같은 결과, 훨씬 빠름)
+    # 파일 쓰기는 스레드에서, 임시 파일에 쓰고 바꿔치기해서 중간에 죽어도 기존 번역 파일이 안 깨짐
+    await asyncio.to_thread(replace_file, EVENTS_EN_JSON_PATH, orjson.dumps(translated_events, option=orjson.OPT_INDENT_2))
+
+    # 메모리의 영어 이벤트와 /events_en 응답도 바로 갱신 (재시작 전까지 예전 번역/ETag가 나가지 않게, 다음 번역 때 이번 결과를 재사용)
+    events_data_en = build_events_en(translated_events)
+    refresh_events_responses()
 
     print(f"Successfully translated and saved {len(translated_events)} events.")
     return {"message": f"Successfully translated {len(translated_events)} events.", "path": EVENTS_EN_JSON_PATH}
 
 
-def compute_event_state(period: str) -> str: #이벤트 상태 계산
-    #이벤트 기간이랑 오늘 날짜 비교해서 이벤트가 예정, 진행중, 종료으로 반환
-    #근데 기간 정보가 없거나 형식 이상하면 알수없음 반환
-    if not period or "~" not in period:
-        return "알수없음"
-    try:
-        start_str, end_str = period.split("~")
-        start_date = datetime.strptime(start_str.strip(), "%Y-%m-%d").date()
-        end_date = datetime.strptime(end_str.strip(), "%Y-%m-%d").date()
+def get_today() -> date:
+    #오늘 날짜 반환 (TODAY_CACHE_TTL 동안 캐시)
+    now = time.monotonic()
+    if _TODAY_CACHE["date"] is None or now - _TODAY_CACHE["checked_at"] > TODAY_CACHE_TTL:
         today = datetime.now().date()
-        if today < start_date:
-            return "예정"
-        elif start_date <= today <= end_date:
-            return "진행중"
-        else:
-            return "종료"
-    except Exception:
-        return "알수없음"
+        if today != _TODAY_CACHE["date"]:
+            _TODAY_CACHE["date"] = today
+            _TODAY_CACHE["str"] = today.strftime("%Y-%m-%d")
+        _TODAY_CACHE["checked_at"] = now
+    return _TODAY_CACHE["date"]
+
+
+def get_today_str() -> str:
+    #오늘 날짜 문자열 (YYYY-MM-DD)
+    get_today()
+    return _TODAY_CACHE["str"]
+
+
+# "YYYY-MM-DD ~ YYYY-MM-DD" 형식의 기간 문자열
+_PERIOD_RE = re.compile(r"^\s*(\d{4})-(\d{1,2})-(\d{1,2})\s*~\s*(\d{4})-(\d{1,2})-(\d{1,2})\s*$")
+
+
+@lru_cache(maxsize=4096)
+def parse_event_period(period: str) -> Optional[Tuple[date, date]]:
+    #기간 문자열을 (시작일, 종료일)로 파싱, 형식이 이상하면 None
+    #strptime 두 번보다 정규식 한 번이 훨씬 빠르고, 같은 기간이 여러 이벤트에 반복되므로 캐시
+    match = _PERIOD_RE.match(period)
+    if not match:
+        return None
+    y1, m1, d1, y2, m2, d2 = map(int, match.groups())
+    try:
+        return date(y1, m1, d1), date(y2, m2, d2)
+    except ValueError: #2025-13-40 같은 없는 날짜
+        return None
+
+
+EVENT_STATES = np.array(["예정", "진행중", "종료", "알수없음"], dtype=object) #event_states_from_periods 상태 코드 순서
+
+
+def parse_event_periods(events: List[dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    #이벤트 기간을 (형식 정상 여부, 시작일, 종료일) numpy 배열로 한 번만 파싱
+    parsed = [parse_event_period(e.get("period") or "") for e in events]
+    known = np.array([p is not None for p in parsed], dtype=bool)
+    start = np.array([p[0].toordinal() if p else 0 for p in parsed], dtype=np.int64)
+    end = np.array([p[1].toordinal() if p else 0 for p in parsed], dtype=np.int64)
+    return known, start, end
+
+
+def event_states_from_periods(periods: Tuple[np.ndarray, np.ndarray, np.ndarray], today: Optional[date] = None) -> List[str]:
+    #파싱해둔 기간 배열과 오늘 날짜를 numpy로 한꺼번에 비교
+    #이벤트 기간이랑 오늘 날짜 비교해서 예정, 진행중, 종료, 기간 정보가 없거나 형식 이상하면 알수없음
+    if today is None:
+        today = get_today()
+    known, start, end = periods
+    t = today.toordinal()
+    codes = np.where(~known, 3, np.where(t < start, 0, np.where(t <= end, 1, 2)))
+    return EVENT_STATES[codes].tolist()
+
+
+# 임베딩용 텍스트에 들어가는 필드 (라벨, 키) - 값이 없어도 항상 들어감
+EVENT_TEXT_FIELDS = (
+    ("제목", "title"),
+    ("장소", "place"),
+    ("주최", "host"),
+    ("기간", "period"),
+    ("상태", "state"),
+)
 
 
 def create_event_text(event: dict) -> str:
     #event.json에서 이벤트 정보를 임베딩용 텍스트로 변환
-    title = event.get("title", "")
-    place = event.get("place", "")
-    host = event.get("host", "")
-    period = event.get("period", "")
-    state = event.get("state", "")
-    description = event.get("description", "")
-
-    text_parts = [
-        f"제목: {title}",
-        f"장소: {place}",
-        f"주최: {host}",
-        f"기간: {period}",
-        f"상태: {state}",
-    ]
+    text_parts = [f"{label}: {event.get(key, '')}" for label, key in EVENT_TEXT_FIELDS]
 
+    description = event.get("description", "")
     if description: #이벤트에 설명 있으면 설명 추가
         text_parts.append(f"설명: {description}")
 
     return " | ".join(text_parts)
 
 
-async def get_embedding(text: str, model: str = "text-embedding-3-small") -> List[float]:
-    #text-embedding-3-small 를 사용하여 텍스트 임베딩 생성
+async def request_embeddings(texts: List[str], model: str = EMBEDDING_MODEL, max_retries: int = OPENAI_MAX_RETRIES) -> List[List[float]]:
+    #텍스트 여러 개를 한 번의 API 호출로 임베딩
     try:
-        response = await openai_client.embeddings.create(
-            input=text,
+        response = await openai_request(
+            embedding_rate_limiter,
+            openai_client.embeddings.create,
+            max_retries=max_retries,
+            input=texts,
             model=model
         )
-        return response.data[0].embedding
+        return [data.embedding for data in response.data]
     except Exception as e:
-        print(f"[get_embedding] Error: {e}")
-        return [0.0] * 1536  # 기본 차원
+        print(f"[request_embeddings] Error: {e}")
+        return [[0.0] * 1536 for _ in texts]  # 기본 차원
+
+
+async def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+    #text-embedding-3-small 를 사용하여 텍스트 임베딩 생성
+    #배처가 돌고 있으면 큐에 넣고, 동시에 들어온 요청들과 한 번에 묶어서 API 호출
+    if embedding_queue is None or model != EMBEDDING_MODEL:
+        return (await request_embeddings([text], model, max_retries=0))[0]
+    future = asyncio.get_running_loop().create_future()
+    embedding_queue.put_nowait((text, future))
+    return await future
+
+
+async def embedding_batcher():
+    #get_embedding 요청을 EMBEDDING_BATCH_WINDOW 동안 (최대 EMBEDDING_BATCH_MAX개) 모아서 한 번에 임베딩
+    loop = asyncio.get_running_loop()
+    in_flight = set() #진행 중인 배치 요청 (태스크가 GC되지 않게 참조 유지)
+    while True:
+        batch = [await embedding_queue.get()]
+        deadline = loop.time() + EMBEDDING_BATCH_WINDOW
+        while len(batch) < EMBEDDING_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(embedding_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # API 응답 기다리는 동안에도 다음 배치를 모을 수 있게 태스크로 넘김
+        task = asyncio.create_task(resolve_embedding_batch(batch))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+
+async def resolve_embedding_batch(batch: list):
+    #모은 요청을 한 번에 임베딩하고 각 요청의 future에 결과 전달
+    # 질문 임베딩은 사용자가 기다리니까 재시도 안 함 (실패하면 0 벡터 -> 키워드 검색으로)
+    embeddings = await request_embeddings([text for text, _ in batch], max_retries=0)
+    for (_, future), embedding in zip(batch, embeddings):
+        if not future.done():
+            future.set_result(embedding)
+
+
+def create_faiss_index(embeddings: np.ndarray) -> faiss.Index:
+    #임베딩 행렬로 FAISS 인덱스 생성
+    #OpenAI 임베딩은 코사인 유사도로 비교해야 하므로 L2 정규화 후 내적(IP)으로 검색
+    #정규화된 벡터끼리의 내적 = 코사인 유사도
+    #벡터는 SQ8(차원당 1바이트)로 양자화해서 저장 -> float32 대비 메모리/대역폭 1/4
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32) #mmap(float16) 캐시면 float32로 복사
+    faiss.normalize_L2(embeddings) #in-place 정규화
+    dimension = embeddings.shape[1]
+    if len(embeddings) > HNSW_THRESHOLD:
+        # 이벤트가 많으면 HNSW 그래프 인덱스로 검색 비용을 O(log N) 수준으로 줄임
+        index_key = f"HNSW{HNSW_M},SQ8"
+    else:
+        index_key = "SQ8" #내적 기반 전수 검색
+    index = faiss.index_factory(dimension, index_key, faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings) #SQ8은 차원별 값 범위를 학습해야 함
+    index.add(embeddings)
+    return index
+
+
+def use_gpu_if_available():
+    #GPU가 있으면 FAISS 인덱스를 GPU로 옮김 (검색 API는 그대로)
+    #faiss-cpu 빌드이거나 GPU가 지원하지 않는 인덱스 종류면 CPU 인덱스를 그대로 사용
+    global faiss_index, gpu_resources
+    if faiss_index is None or not hasattr(faiss, "StandardGpuResources"):
+        return
+    try:
+        if faiss.get_num_gpus() == 0:
+            return
+        if gpu_resources is None:
+            gpu_resources = faiss.StandardGpuResources()
+        faiss_index = faiss.index_cpu_to_gpu(gpu_resources, 0, faiss_index)
+        print("[use_gpu_if_available] FAISS index moved to GPU")
+    except Exception as e:
+        print(f"[use_gpu_if_available] Keeping CPU index: {e}")
+
+
+def embedding_cache_key(text: str) -> str:
+    #임베딩 캐시 키: 모델 이름 + 텍스트의 sha256
+    #모델을 바꾸면 키가 전부 달라지므로 예전 모델의 임베딩을 잘못 쓰는 일이 없음
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+
+async def load_embeddings_cache(keys: List[str]) -> Tuple[List[str], Optional[np.ndarray]]:
+    #디스크 캐시에서 (키 리스트, 임베딩 행렬) 로드, 없으면 ([], None)
+    #.npy 바이너리 + 키 파일을 우선 사용하고, 없으면 예전 JSON 캐시를 읽음
+    if EMBEDDINGS_CACHE_PATH.exists() and EMBEDDINGS_KEYS_PATH.exists():
+        cached_keys = await asyncio.to_thread(read_json_file, EMBEDDINGS_KEYS_PATH) or []
+        # mmap으로 열어서 실제로 읽는 부분만 OS 페이지 캐시에 올라감
+        embeddings = np.load(EMBEDDINGS_CACHE_PATH, mmap_mode="r")
+        if len(cached_keys) == len(embeddings):
+            return cached_keys, embeddings
+    elif LEGACY_EMBEDDINGS_CACHE_PATH.exists():
+        cache_data = await asyncio.to_thread(read_json_file, LEGACY_EMBEDDINGS_CACHE_PATH) or {}
+        embeddings = np.array(cache_data.get("embeddings", []), dtype=np.float32)
+        if len(embeddings) == len(keys): #예전 캐시는 키가 없어서 이벤트 순서와 같다고 보고 현재 키를 붙임
+            return list(keys), embeddings
+    return [], None
+
+
+def replace_file(path: Path, data: bytes):
+    #임시 파일에 다 쓴 다음 os.replace로 바꿔치기 (쓰다가 죽어도 반쯤 쓰인 파일이 안 남음)
+    #임시 파일은 쓰는 쪽마다 따로 만듦 (워커 여러 개가 같은 파일을 써도 서로의 임시 파일을 덮어쓰지 않음)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644) #mkstemp는 0600으로 만들어서 일반 파일 권한으로 맞춤
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True) #실패하면 임시 파일 정리
+        raise
+
+
+def save_vector_cache(keys: List[str], embeddings: np.ndarray, index):
+    #임베딩 행렬(float16 .npy), 행별 캐시 키, FAISS 인덱스를 저장
+    #index가 None이면 인덱스 파일은 안 씀 (다음 시작 때 새로 만듦)
+    #행렬과 키/인덱스가 서로 안 맞는 상태로 남지 않도록 키 파일과 인덱스를 먼저 지우고 마지막에 씀
+    #(중간에 죽으면 다음 시작 때 캐시가 없는 걸로 보고 다시 만듦)
+    for path in (EMBEDDINGS_KEYS_PATH, FAISS_INDEX_PATH):
+        path.unlink(missing_ok=True)
+    buffer = io.BytesIO()
+    np.save(buffer, embeddings.astype(np.float16)) #JSON보다 4배 이상 작고 로드가 훨씬 빠름
+    replace_file(EMBEDDINGS_CACHE_PATH, buffer.getbuffer())
+    replace_file(EMBEDDINGS_KEYS_PATH, orjson.dumps(keys))
+    if index is not None:
+        replace_file(FAISS_INDEX_PATH, faiss.serialize_index(index).tobytes())
+
+
+async def embed_text_batch(texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+    #임베딩용 텍스트 배치 하나의 임베딩 생성
+    async with semaphore:
+        # 배치로 임베딩 요청
+        try:
+            response = await openai_request(
+                embedding_rate_limiter,
+                openai_client.embeddings.create,
+                input=texts,
+                model=EMBEDDING_MODEL
+            )
+            return [data.embedding for data in response.data] #배치 임베딩 리스트
+        except Exception as e:
+            print(f"[embed_text_batch] Batch error: {e}")
+            # 에러 발생시 개별 처리
+            return [(await request_embeddings([text]))[0] for text in texts]
 
 
 async def build_vector_database():
+    #워커가 여러 개면 잠금을 잡은 워커 하나만 임베딩 + 캐시 저장
+    #나머지는 기다렸다가 그 워커가 저장한 캐시/인덱스를 바로 로드 (임베딩 API 호출이 워커 수만큼 늘지 않음)
+    with open(VECTOR_CACHE_LOCK_PATH, "ab") as lock_file:
+        if fcntl:
+            await asyncio.to_thread(fcntl.flock, lock_file.fileno(), fcntl.LOCK_EX)
+        await _build_vector_database() #파일을 닫으면 잠금도 풀림
+
+
+async def _build_vector_database():
     #이벤트 데이터의 벡터 데이터베이스 구축
     #요약
-    #json에 캐쉬 있는지 확인 -> 있으면 로드 -> FAISS 인덱스 생성
-    #없으면 이벤트 데이터 임베딩 생성 -> FAISS 인덱스 생성 -> 캐쉬 저장
-    
+    #이벤트 텍스트마다 캐시 키(모델 + 텍스트 해시) 계산
+    #캐시 키가 저장된 것과 완전히 같고 FAISS 인덱스 파일이 있으면 mmap으로 바로 로드
+    #아니면 캐시에 없는 텍스트만 임베딩 생성 -> FAISS 인덱스 생성 -> 캐쉬 저장
+
     global event_embeddings, faiss_index
 
     if not openai_client or not events_data:
         print("[build_vector_database] No OpenAI client or events data")
         return
 
-    # 캐시 확인
-    if EMBEDDINGS_CACHE_PATH.exists(): #캐쉬파일 존재하면
-        try:
-            async with aiofiles.open(str(EMBEDDINGS_CACHE_PATH), "r", encoding="utf-8") as f: #비동기로 파일 연다
-                cache_data = json.loads(await f.read())
-                embeddings_list = cache_data.get("embeddings", [])
-                if len(embeddings_list) == len(events_data): #임베딩 수가 이벤트 수와 같으면
-                    event_embeddings = np.array(embeddings_list, dtype=np.float32) #numpy 배열로 변환
-                    print(f"[build_vector_database] Loaded {len(embeddings_list)} embeddings from cache")
-
-                    # FAISS 인덱스 생성
-                    dimension = event_embeddings.shape[1]
-                    faiss_index = faiss.IndexFlatL2(dimension)
-                    faiss_index.add(event_embeddings)
-                    return
-        except Exception as e:
-            print(f"[build_vector_database] Cache load error: {e}")
-
-    # 캐시가 없으면 새로 생성
-    print(f"[build_vector_database] Creating embeddings for {len(events_data)} events...")
-
+    # 각 이벤트에 대해 임베딩용 텍스트와 캐시 키 생성
+    texts = event_texts #로드할 때 미리 만들어둔 텍스트
+    keys = [embedding_cache_key(text) for text in texts]
 
-    embeddings_list = []  # 모든 이벤트 임베딩 저장용
-    # 배치 처리로 임베딩 생성 (API 호출 최적화)
-    # 이벤트 개많아서 50개씩 나눠서 처리함
-    batch_size = 50
-    for i in range(0, len(events_data), batch_size):
-        batch = events_data[i:i + batch_size] #이벤트 배치
-         #배치의 각 이벤트에 대해 임베딩용 텍스트 생성
-        texts = [create_event_text(event) for event in batch] #임베딩용 텍스트 리스트
+    # 캐시 확인
+    try:
+        cached_keys, cached = await load_embeddings_cache(keys)
+    except Exception as e:
+        print(f"[build_vector_database] Cache load error: {e}")
+        cached_keys, cached = [], None
 
-        # 배치로 임베딩 요청
+    # 저장된 인덱스 확인 (학습/추가 단계를 통째로 건너뜀)
+    # 캐시 키가 지금 이벤트들과 똑같을 때만 인덱스도 그대로 쓸 수 있음
+    if cached_keys == keys and FAISS_INDEX_PATH.exists():
         try:
-            response = await openai_client.embeddings.create(
-                input=texts,
-                model="text-embedding-3-small"
-            )
-            batch_embeddings = [data.embedding for data in response.data] #배치 임베딩 리스트
-            embeddings_list.extend(batch_embeddings) #전체 임베딩 리스트에 추가
-            print(f"[build_vector_database] Processed {len(embeddings_list)}/{len(events_data)} events")
+            index = faiss.read_index(str(FAISS_INDEX_PATH), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            if index.ntotal == len(events_data): #인덱스 벡터 수가 이벤트 수와 같으면
+                # 검색은 인덱스만 있으면 되므로 임베딩 행렬은 만들지 않음 (mmap이라 첫 검색 전까지 메모리도 거의 안 씀)
+                faiss_index = index
+                print(f"[build_vector_database] Loaded FAISS index with {index.ntotal} vectors")
+                return
         except Exception as e:
-            print(f"[build_vector_database] Batch error: {e}")
-            # 에러 발생시 개별 처리
-            for text in texts: #개별 텍스트에 대해 임베딩 생성
-                embedding = await get_embedding(text) #임베딩 생성
-                embeddings_list.append(embedding)
-
-        # API 레이트 리밋 방지
-        await asyncio.sleep(0.5)
-
-    event_embeddings = np.array(embeddings_list, dtype=np.float32) #numpy 배열로 변환
+            print(f"[build_vector_database] Index load error: {e}")
+
+    # 캐시에 없는 텍스트만 모음
+    # 같은 행사가 여러 번 크롤링되면 텍스트(키)가 똑같으니까 중복 제거 후 한 번씩만 임베딩
+    # 0 벡터(임베딩 실패)로 저장된 행은 캐시에 없는 걸로 봄
+    cached_valid = np.asarray(cached).any(axis=1) if cached is not None and len(cached_keys) else []
+    key_to_row = {key: row for row, key in enumerate(cached_keys) if cached_valid[row]}
+    missing = {key: text for key, text in zip(keys, texts) if key not in key_to_row}
+    cached_count = sum(1 for key in keys if key in key_to_row)
+    print(f"[build_vector_database] {cached_count} events cached, {len(missing)} unique texts to embed")
+
+    new_embeddings = {}
+    if missing:
+        # 배치 처리로 임베딩 생성 (API 호출 최적화)
+        # 이벤트 개많아서 50개씩 나눠서 처리함
+        # 배치 요청은 동시에 보내고 세마포어로 동시 요청 수만 제한 (레이트 리밋 방지)
+        missing_keys = list(missing.keys())
+        missing_texts = list(missing.values())
+        batch_size = 50
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        tasks = [
+            embed_text_batch(missing_texts[i:i + batch_size], semaphore)
+            for i in range(0, len(missing_texts), batch_size)
+        ]
+        results = await asyncio.gather(*tasks) #gather는 입력 순서대로 결과를 돌려줌
+
+        embeddings_list = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+        new_embeddings = dict(zip(missing_keys, embeddings_list))
+        print(f"[build_vector_database] Embedded {len(embeddings_list)} texts")
+
+    # 캐시 + 새 임베딩으로 이벤트 순서대로 행렬 구성
+    event_embeddings = np.array(
+        [cached[key_to_row[key]] if key in key_to_row else new_embeddings[key] for key in keys],
+        dtype=np.float32,
+    ) #numpy 배열로 변환
 
     # FAISS 인덱스 생성
-    dimension = event_embeddings.shape[1]
-    faiss_index = faiss.IndexFlatL2(dimension) #L2 거리 기반 유사도 검색
-    faiss_index.add(event_embeddings) #임베딩 추가
-    #이러면 search_similar_events에서 FAISS를 통해 가장 유사한 이벤트를 개빠르게 찾을 수 있음
+    faiss_index = create_faiss_index(event_embeddings)
+    #이러면 search_similar_indices에서 FAISS를 통해 가장 유사한 이벤트를 개빠르게 찾을 수 있음
 
     # 캐시 저장
     try:
-        cache_data = {"embeddings": embeddings_list}
-        async with aiofiles.open(str(EMBEDDINGS_CACHE_PATH), "w", encoding="utf-8") as f: #비동기로 파일 열기
-            await f.write(json.dumps(cache_data)) #캐시 데이터 저장
+        # 디스크 쓰기는 스레드에서 처리해서 그동안 이벤트 루프가 다른 요청을 처리할 수 있게 함
+        # 인덱스도 저장해서 다음엔 바로 로드
+        # 임베딩 실패한 행(0 벡터)은 저장 안 함 -> 다음 시작 때 다시 임베딩
+        # 그런 행이 하나라도 있으면 인덱스도 저장 안 함 (키가 안 맞아서 어차피 다시 만듦)
+        valid = event_embeddings.any(axis=1)
+        save_keys = [key for key, ok in zip(keys, valid) if ok]
+        save_index = faiss_index if valid.all() else None
+        if not valid.all():
+            print(f"[build_vector_database] {int((~valid).sum())} failed embeddings not cached")
+        await asyncio.to_thread(save_vector_cache, save_keys, event_embeddings[valid], save_index)
         print("[build_vector_database] Embeddings cached successfully")
     except Exception as e:
         print(f"[build_vector_database] Cache save error: {e}")
 
-    #json으로 캐쉬 저장해서 다음에 api 안쓰고 빠르게 로딩 가능함 재활용 느낌
-
-
-async def search_similar_events(query: str, top_k: int = 20) -> List[dict]:
-    #rag - 쿼리와 유사한 이벤트 검색
-    #query : 사용자 질문
-    #top_k : 반환할 유사 이벤트 개수
-    #요약
-    #쿼리 임베딩 생성 -> FAISS로 유사도 검색 -> 유사 이벤트 반환
-    if not faiss_index or not openai_client:
-        return events_data[:top_k]
+    #npy로 캐쉬 저장해서 다음에 api 안쓰고 빠르게 로딩 가능함 재활용 느낌
+
+
+async def get_query_vector(query: str) -> np.ndarray:
+    #검색용 질문 벡터 반환 (정규화된 1 x d 배열)
+    #공백/대소문자만 다른 질문은 같은 키로 보고 캐시에서 바로 꺼냄
+    #키는 이벤트 캐시와 같은 모델 + 텍스트 해시 (모델 바뀌면 자동으로 캐시 무효, 긴 질문도 키는 64자)
+    key = embedding_cache_key(query.strip().lower())
+    cached = query_embedding_cache.get(key)
+    if cached is not None:
+        query_embedding_cache.move_to_end(key) #최근 사용으로 갱신
+        return cached
+
+    # 같은 질문이 동시에 여러 개 들어오면 임베딩 요청은 하나만 보내고 나머지는 그 결과를 같이 기다림
+    task = query_embedding_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(embed_query(query, key))
+        query_embedding_inflight[key] = task
+        task.add_done_callback(lambda _: query_embedding_inflight.pop(key, None))
+    return await asyncio.shield(task) #기다리던 요청 하나가 취소돼도 다른 요청은 계속 기다릴 수 있게
+
+
+async def embed_query(query: str, key: str) -> np.ndarray:
+    #질문 임베딩 생성 + 정규화 후 LRU 캐시에 저장
+    query_embedding = await get_embedding(query)
+    query_vector = np.array([query_embedding], dtype=np.float32) #2차원 배열로 변환 왜냐하면 faiss가 2차원으로만 검색 가능
+    if not query_vector.any(): #get_embedding 에러시 0 벡터 -> 캐시하지 않음
+        return query_vector
+    faiss.normalize_L2(query_vector) #이벤트 임베딩과 같은 기준으로 정규화
+
+    query_embedding_cache[key] = query_vector
+    if len(query_embedding_cache) > QUERY_CACHE_SIZE:
+        query_embedding_cache.popitem(last=False) #가장 오래된 질문 제거
+    return query_vector
+
+
+def lookup_cached_response(query_vector: np.ndarray) -> Optional[dict]:
+    #저장된 질문 중 유사도가 임계값 이상이고 아직 유효한 답변이 있으면 반환
+    if response_cache_vectors is None:
+        return None
+    n = min(response_cache_next, RESPONSE_CACHE_SIZE)
+    scores = response_cache_vectors[:n] @ query_vector[0] #정규화돼 있으니까 내적 = 코사인 유사도
+    valid = (time.monotonic() - response_cache_created[:n] < RESPONSE_CACHE_TTL) & (response_cache_days[:n] == get_today().toordinal())
+    scores[~valid] = -1.0 #만료됐거나 날짜가 바뀐 답변은 제외
+    best = int(np.argmax(scores))
+    if scores[best] < RESPONSE_CACHE_THRESHOLD:
+        return None
+    response_cache_used[best] = time.monotonic() #최근 사용으로 갱신
+    return response_cache_entries[best]
+
+
+def store_cached_response(query_vector: np.ndarray, response: dict):
+    #답변을 빈 칸에, 꽉 찼으면 가장 오래 안 쓴 칸에 저장
+    global response_cache_vectors, response_cache_next
+    if response_cache_vectors is None:
+        response_cache_vectors = np.zeros((RESPONSE_CACHE_SIZE, query_vector.shape[1]), dtype=np.float32)
+    slot = response_cache_next if response_cache_next < RESPONSE_CACHE_SIZE else int(np.argmin(response_cache_used))
+    now = time.monotonic()
+    response_cache_vectors[slot] = query_vector[0]
+    response_cache_created[slot] = now
+    response_cache_used[slot] = now
+    response_cache_days[slot] = get_today().toordinal()
+    response_cache_entries[slot] = response
+    response_cache_next += 1
+
+
+# 키워드 검색용 토큰 (한글/영문/숫자 단어)과 인덱싱할 필드
+_TOKEN_RE = re.compile(r"\w+")
+LEXICAL_FIELDS = ("title", "place", "host", "description")
+
+
+def build_event_token_index():
+    #이벤트 필드의 토큰 -> 이벤트 인덱스 역색인을 로드할 때 한 번만 만들어둠
+    #검색할 때는 질문 토큰마다 dict 조회만 하면 되므로 이벤트 전체를 훑을 필요 없음
+    global event_token_index
+    index = defaultdict(list)
+    for i, e in enumerate(events_data):
+        text = " ".join(str(e.get(field) or "") for field in LEXICAL_FIELDS).lower()
+        for token in set(_TOKEN_RE.findall(text)):
+            index[token].append(i)
+    event_token_index = dict(index)
+
+
+def search_lexical_indices(query: str, top_k: int = 20) -> List[int]:
+    #질문과 겹치는 토큰이 많은 이벤트 순으로 인덱스 반환 (임베딩을 못 쓸 때 대신 사용)
+    scores = Counter()
+    for token in set(_TOKEN_RE.findall(query.lower())):
+        scores.update(event_token_index.get(token, ()))
+    return [idx for idx, _ in scores.most_common(top_k)]
+
+
+def fallback_indices(query: str, top_k: int) -> List[int]:
+    #벡터 검색을 못 할 때 쓰는 결과: 키워드 역색인, 그것도 없으면 처음부터 top_k개
+    return search_lexical_indices(query, top_k) or list(range(min(top_k, len(events_data))))
+
+
+def search_similar_indices(query_vector: Optional[np.ndarray], top_k: int = 20, query: str = "", min_score: float = 0.0) -> List[int]:
+    #질문 벡터와 유사한 이벤트의 인덱스(events_data 위치) 리스트 반환
+    #chatbot은 이벤트 dict가 아니라 인덱스만 있으면 되므로 복사 없이 인덱스만 넘김
+    #임베딩이 없거나 실패하면(0 벡터) 키워드 역색인으로, 그것도 없으면 처음부터 top_k개
+    #min_score : 1등 결과의 유사도(정규화 벡터 내적)가 이보다 낮으면 빈 리스트 (나머지 결과는 점수로 거르지 않음)
+    #키워드 검색은 벡터 검색을 못 쓸 때만 실행 (보통은 FAISS 결과만 있으면 되므로 질문 토큰화도 안 함)
+    if not faiss_index or query_vector is None or not query_vector.any():
+        return fallback_indices(query, top_k)
 
     try:
-        # 쿼리 임베딩 생성
-        query_embedding = await get_embedding(query) #쿼리를 벡터로 변환
-        query_vector = np.array([query_embedding], dtype=np.float32) #2차원 배열로 변환 왜냐하면 faiss가 2차원으로만 검색 가능
-
         # FAISS로 유사도 검색
         distances, indices = faiss_index.search(query_vector, min(top_k, len(events_data)))
         # indices: 유사한 이벤트의 인덱스 리스트
         # min(top_k, len(events_data)) : 이벤트 개수보다 top_k가 크면 오류나니까 방지
+        if distances[0][0] < min_score: #SQ8 근사 점수라 개별 결과는 자르지 않고 1등 점수로만 판단
+            return []
+        return [int(idx) for idx in indices[0] if 0 <= idx < len(events_data)]
+    except Exception as e:
+        print(f"[search_similar_indices] Error: {e}")
+        return fallback_indices(query, top_k)
 
-        # 결과 반환
-        similar_events = []
-        for idx in indices[0]:
-            if 0 <= idx < len(events_data):
-                event = events_data[idx].copy() #인덱스에 해당하는 이벤트 복사
-                similar_events.append(event) #유사 이벤트 순서대로 리스트에 추가
 
-        return similar_events
-    except Exception as e:
-        print(f"[search_similar_events] Error: {e}")
-        return events_data[:top_k] #에러시 그냥 처음부터 top_k개 반환
+def build_events_response(events: List[dict]) -> Tuple[bytes, str]:
+    #이벤트 목록 응답을 JSON 바이트로 미리 직렬화하고 내용 해시로 ETag 생성
+    body = orjson.dumps({"events": events})
+    return body, '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+def refresh_events_responses():
+    #/events, /events_en 응답 캐시 갱신 (이벤트 데이터가 바뀌면 꼭 호출)
+    global events_response, events_en_response
+    events_response = build_events_response(events_data)
+    events_en_response = build_events_response(events_data_en if events_data_en else events_data)
+
+
+def cached_json_response(request: Request, cached: Tuple[bytes, str]) -> Response:
+    #미리 만든 JSON 바이트를 그대로 보냄, 브라우저가 같은 ETag를 갖고 있으면 본문 없이 304
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def build_event_compact_json():
+    #챗봇 프롬프트용 이벤트 요약을 미리 JSON 문자열로 만들어둠
+    #이벤트는 시작 후 안 바뀌니까 요청마다 dict 만들고 json.dumps 할 필요 없음
+    #orjson은 한글을 이스케이프하지 않음 (ensure_ascii=False와 같은 결과)
+    global event_compact_json
+    event_compact_json = [
+        orjson.dumps({
+            "id": e.get("id"),
+            "title": e.get("title"),
+            "period": e.get("period"),
+            "place": e.get("place"),
+            "host": e.get("host"),
+            "state": e.get("state"),
+            "url": e.get("url") or e.get("link") or "#",
+        }).decode()
+        for e in events_data
+    ]
 
 
 # =========================
 # Lifespan
 # =========================
+def read_json_file(path: Path):
+    #파일을 mmap으로 열어서 orjson으로 바로 파싱 (중간에 bytes/str 복사본 안 만듦)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: #빈 파일은 mmap 못 함
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view) #orjson은 mmap을 직접 못 받아서 memoryview로 넘김
+
+
+async def load_events_file(path: Path) -> List[dict]:
+    #이벤트 JSON 파일 로드 (리스트 또는 {"events": [...]} 형식 모두 지원)
+    # 읽기 + 파싱을 스레드에서 (한국어 / 영어 파일을 gather로 같이 읽을 때 디스크 읽기가 겹침)
+    data = await asyncio.to_thread(read_json_file, path)
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and "events" in data:
+        return data["events"]
+    return []
+
+
+@app.on_event("startup")
+async def start_embedding_batcher():
+    # 질문 임베딩 마이크로 배처 시작
+    global embedding_queue, embedding_batcher_task
+    if not openai_client:
+        return
+    embedding_queue = asyncio.Queue()
+    embedding_batcher_task = asyncio.create_task(embedding_batcher())
+
+
+@app.on_event("shutdown")
+async def stop_embedding_batcher():
+    global embedding_queue, embedding_batcher_task
+    if embedding_batcher_task:
+        embedding_batcher_task.cancel()
+    embedding_queue = None
+    embedding_batcher_task = None
+
+
+def build_events_en(raw_events_en: List[dict]) -> List[dict]:
+    #영어 파일(번역 결과)에 id/상태를 붙임
+    events_en = [{**event, "id": i} for i, event in enumerate(raw_events_en)]
+    for e in events_en:
+        e["state"] = e.get("state") or "Unknown"
+    return events_en
+
+
+def prepare_events(raw_events: List[dict], raw_events_en: List[dict]):
+    #파일에서 읽은 이벤트에 id/상태를 붙이고 요청 처리에 쓰는 캐시들을 한 번에 만듦
+    global events_data, events_data_en, event_texts, event_periods
+
+    # --- 한국어 파일 ---
+    # 복사 + id + 상태를 한 번에 (기간은 여기서 한 번만 파싱해두고 상태 갱신 때 재사용)
+    event_periods = parse_event_periods(raw_events)
+    states = event_states_from_periods(event_periods) #이벤트 상태 계산
+    events_data = [{**event, "id": i, "state": state} for i, (event, state) in enumerate(zip(raw_events, states))]
+
+    # --- 영어 파일 ---
+    events_data_en = build_events_en(raw_events_en)
+
+    # 임베딩용 텍스트 / 프롬프트용 JSON은 로드할 때 한 번만 만들어둠
+    event_texts = [create_event_text(e) for e in events_data]
+    build_event_compact_json()
+    build_event_token_index()
+    refresh_events_responses()
+
+
+def refresh_event_states(today: Optional[date] = None) -> int:
+    #날짜가 바뀌면 파싱해둔 기간으로 상태만 다시 계산, 바뀐 이벤트 수 반환
+    #임베딩 텍스트(event_texts)는 FAISS 인덱스와 맞춰야 하므로 그대로 둠
+    if event_periods is None or len(event_periods[0]) != len(events_data):
+        return 0
+    changed = 0
+    for e, state in zip(events_data, event_states_from_periods(event_periods, today)):
+        if e.get("state") != state:
+            e["state"] = state
+            changed += 1
+    if changed:
+        build_event_compact_json()
+        refresh_events_responses()
+    return changed
+
+
+async def event_state_refresher():
+    #자정이 지나면 이벤트 상태 갱신 (서버를 며칠 켜둬도 예정 -> 진행중 -> 종료가 반영됨)
+    while True:
+        now = datetime.now()
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        await asyncio.sleep((next_midnight - now).total_seconds() + 1)
+        try:
+            changed = refresh_event_states(datetime.now().date())
+            print(f"[event_state_refresher] {changed} event states updated")
+        except Exception as e:
+            print(f"[event_state_refresher] Error: {e}")
+
+
+@app.on_event("startup")
+async def start_event_state_refresher():
+    global event_state_task
+    event_state_task = asyncio.create_task(event_state_refresher())
+
+
+@app.on_event("shutdown")
+async def stop_event_state_refresher():
+    global event_state_task
+    if event_state_task:
+        event_state_task.cancel()
+    event_state_task = None
+
+
 @app.on_event("startup")
 async def load_events_data():
     # 한국어, 영어 events 파일 모두 로드 및 벡터 DB 구축
     global events_data, events_data_en
     try:
-        # --- 한국어 파일 ---
-        async with aiofiles.open(str(EVENTS_JSON_PATH), "r", encoding="utf-8") as f:
-            data = json.loads(await f.read())
-            if isinstance(data, list):
-                raw_events = data
-            elif isinstance(data, dict) and "events" in data:
-                raw_events = data["events"]
-            else:
-                raw_events = []
-        events_data = [{**event, "id": i} for i, event in enumerate(raw_events)]
-        for e in events_data:
-            e["state"] = compute_event_state(e.get("period") or "") #이벤트 상태 계산
-
-        # --- 영어 파일 (있을 경우) ---
-        if EVENTS_EN_JSON_PATH.exists():
-            async with aiofiles.open(str(EVENTS_EN_JSON_PATH), "r", encoding="utf-8") as f_en:
-                data_en = json.loads(await f_en.read())
-                if isinstance(data_en, list):
-                    raw_events_en = data_en
-                elif isinstance(data_en, dict) and "events" in data_en:
-                    raw_events_en = data_en["events"]
-                else:
-                    raw_events_en = []
-            events_data_en = [{**event, "id": i} for i, event in enumerate(raw_events_en)]
-            for e in events_data_en:
-                e["state"] = e.get("state") or "Unknown"
-        else:
-            events_data_en = []
+        # 한국어 / 영어 파일은 서로 상관없으니까 동시에 읽음
+        load_tasks = [asyncio.wait_for(load_events_file(EVENTS_JSON_PATH), timeout=EVENTS_LOAD_TIMEOUT)]
+        if EVENTS_EN_JSON_PATH.exists(): #영어 파일 (있을 경우)
+            load_tasks.append(asyncio.wait_for(load_events_file(EVENTS_EN_JSON_PATH), timeout=EVENTS_LOAD_TIMEOUT))
+        results = await asyncio.gather(*load_tasks)
+        raw_events = results[0]
+        raw_events_en = results[1] if len(results) > 1 else []
+
+        # 상태 계산 / 텍스트, JSON, 역색인 만들기 (startup이 끝나야 요청을 받으니까 그냥 바로 실행)
+        prepare_events(raw_events, raw_events_en)
 
         print(f"[startup] Loaded {len(events_data)} Korean events, {len(events_data_en)} English events.")
 
         # 벡터 데이터베이스 구축
         await build_vector_database()
+        use_gpu_if_available()
 
     except Exception as e:
         print(f"[startup] Error loading events: {e}")
         events_data = []
         events_data_en = []
+        refresh_events_responses()
 
 
 # =========================
@@ -386,40 +955,10 @@ async def feed_page(request: Request):
 # =========================
 # Chatbot Logic with RAG
 # =========================
-async def chatbot(message: str, chat_history: list = None, session_id: str = None) -> dict:
-    #RAG 기반 챗봇: 벡터 유사도 검색으로 관련 이벤트를 찾아 답변 생성
-    if not message:
-        return {"response": "메시지를 입력해주세요."}
-
-    if not openai_client:
-        return {"response": "OpenAI API 키가 설정되어 있지 않습니다."}
-
-    # 세션별 대화 기록 관리
-    if session_id:
-        if session_id not in conversation_memory:
-            conversation_memory[session_id] = []
-        history = conversation_memory[session_id]
-    else:
-        history = chat_history or []
-
-    #RAG: 벡터 유사도 검색으로 관련 이벤트 찾기
-    similar_events = await search_similar_events(message, top_k=20)
-
-    # compact_events 구성
-    compact_events = [
-        {
-            "id": e.get("id"),
-            "title": e.get("title"),
-            "period": e.get("period"),
-            "place": e.get("place"),
-            "host": e.get("host"),
-            "state": e.get("state"),
-            "url": e.get("url") or e.get("link") or "#",
-        }
-        for e in similar_events
-    ]
-
-    system_prompt = f"""
+# 챗봇 시스템 프롬프트 (고정 부분)
+# 요청마다 바뀌는 오늘 날짜와 검색된 이벤트는 chatbot()에서 별도 메시지로 넣음
+# -> 앞부분이 매 요청 바이트 단위로 똑같아서 OpenAI 프롬프트 캐시가 적중함
+SYSTEM_PROMPT = """
 You are an AI chatbot that recommends cultural events, exhibitions, and festivals in South Korea.
 Your response MUST be in JSON format.
 The 'recommended_event' field must always be an array. Do NOT change the field structure.
@@ -432,7 +971,7 @@ The 'recommended_event' field must always be an array. Do NOT change the field s
 # - Remove irrelevant content
 # - Include date, place, and host information
 # - Remember last 4 conversations and reflect context
-# - Today's date: {datetime.now().strftime('%Y-%m-%d')}
+# - Use today's date given with the retrieved events
 # - If any field is missing, set it to "Unknown" (Korean: "알수없음")
 
 ### CRITICAL: Language Translation Rules
@@ -447,81 +986,111 @@ The 'recommended_event' field must always be an array. Do NOT change the field s
 Example 1 (Korean Input):
 User: 이번 주말에 갈 전시 추천해줘
 Assistant:
-{{
-  "response": {{
-    "intent": "event_search",
-    "recommended_event": [
-        {{
-            "id": 101,
-            "title": "서울 현대미술 전시",
-            "place": "서울 시립미술관",
-            "host": "서울시",
-            "period": "2025-11-15~2025-11-20",
-            "state": "예정",
-            "url": "http://example.com/seoul-art-exhibit"
-        }}
-    ],
-    "reason": {{
-        "ko": "이번 주말에 서울에서 진행되는 현대미술 전시입니다.",
-        "en": "A contemporary art exhibition in Seoul this weekend."
-    }}
-  }}
-}}
+{"response":{"intent":"event_search","recommended_event":[{"id":101,"title":"서울 현대미술 전시","place":"서울 시립미술관","host":"서울시","period":"2025-11-15~2025-11-20","state":"예정","url":"http://example.com/seoul-art-exhibit"}],"reason":{"ko":"이번 주말에 서울에서 진행되는 현대미술 전시입니다.","en":"A contemporary art exhibition in Seoul this weekend."}}}
 
 Example 2 (English Input):
 User: What exhibitions are available this weekend?
 Assistant:
-{{
-  "response": {{
-    "intent": "event_search",
-    "recommended_event": [
-        {{
-            "id": 101,
-            "title": "Seoul Contemporary Art Exhibition",
-            "place": "Seoul Museum of Art",
-            "host": "Seoul Metropolitan Government",
-            "period": "2025-11-15~2025-11-20",
-            "state": "Scheduled",
-            "url": "http://example.com/seoul-art-exhibit"
-        }}
-    ],
-    "reason": {{
-        "ko": "이번 주말에 서울에서 진행되는 현대미술 전시입니다.",
-        "en": "A contemporary art exhibition in Seoul this weekend."
-    }}
-  }}
-}}
+{"response":{"intent":"event_search","recommended_event":[{"id":101,"title":"Seoul Contemporary Art Exhibition","place":"Seoul Museum of Art","host":"Seoul Metropolitan Government","period":"2025-11-15~2025-11-20","state":"Scheduled","url":"http://example.com/seoul-art-exhibit"}],"reason":{"ko":"이번 주말에 서울에서 진행되는 현대미술 전시입니다.","en":"A contemporary art exhibition in Seoul this weekend."}}}
 
 ### Now respond to the user's question with the same JSON structure as shown in the examples above.
-Today's date: {datetime.now().strftime('%Y-%m-%d')}
-Retrieved events (via semantic search): {json.dumps(compact_events, ensure_ascii=False)}
 """
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT} #모든 요청이 같은 객체를 맨 앞에 씀 (수정 금지)
+
 
-    # messages 구성: system + 최근 4개 대화 + 사용자 입력
-    messages = [{"role": "system", "content": system_prompt}]
-    for h in history[-4:]:
-        messages.append({"role": "assistant" if h["role"] == "assistant" else "user", "content": str(h["content"])})
+async def chatbot(message: str, chat_history: list = None, session_id: str = None) -> dict:
+    #RAG 기반 챗봇: 벡터 유사도 검색으로 관련 이벤트를 찾아 답변 생성
+    if not message:
+        return {"response": "메시지를 입력해주세요."}
+
+    if not openai_client:
+        return {"response": "OpenAI API 키가 설정되어 있지 않습니다."}
+
+    # 너무 긴 질문은 잘라서 씀 (임베딩 입력 한도 / 프롬프트 크기는 아래에서 검색 결과로 맞춤)
+    message = message[:MAX_MESSAGE_CHARS]
+
+    # 질문 임베딩 요청을 먼저 보내두고, 응답 기다리는 동안 히스토리 정리
+    query_task = asyncio.create_task(get_query_vector(message)) if faiss_index else None
+
+    # 세션별 대화 기록 관리
+    if session_id:
+        history = conversation_memory.get(session_id)
+        if history is None:
+            history = deque(maxlen=MAX_HISTORY_MESSAGES)
+            conversation_memory[session_id] = history
+            if len(conversation_memory) > MAX_SESSIONS:
+                conversation_memory.popitem(last=False) #가장 오래 안 쓴 세션 삭제
+        else:
+            conversation_memory.move_to_end(session_id) #최근 사용으로 갱신
+    else:
+        history = chat_history or []
+        # 웹 UI는 지금 보내는 질문도 chat_history 끝에 넣어서 보냄 -> 빼고 씀 (프롬프트에 두 번 안 들어가고, 첫 질문이면 history가 비어서 답변 캐시 사용)
+        if history and history[-1].get("role") == "user" and str(history[-1].get("content", "")).strip() == message:
+            history = history[:-1]
+
+    #RAG: 벡터 유사도 검색으로 관련 이벤트 찾기
+    query_vector = await query_task if query_task is not None else None
+
+    # 이전 대화가 없는 질문은 답변이 질문에만 달려 있으니까 의미 캐시 확인
+    cacheable = not session_id and not history and query_vector is not None and query_vector.any()
+    if cacheable:
+        cached_response = lookup_cached_response(query_vector)
+        if cached_response is not None:
+            return cached_response
+
+    similar_indices = search_similar_indices(query_vector, top_k=20, query=message, min_score=RETRIEVAL_MIN_SCORE)
+
+    # messages 구성: 고정 system + 최근 4개 대화 + 검색 결과 + 사용자 입력
+    # 바뀌는 부분을 마지막 질문 바로 앞에 둬야 앞쪽(고정 프롬프트 + 이전 대화)이 프롬프트 캐시에 걸림
+    messages = [SYSTEM_MESSAGE]
+    for h in islice(history, max(len(history) - 4, 0), None):
+        role = "assistant" if h["role"] == "assistant" else "user"
+        content = str(h["content"])
+        # 사용자 메시지만 자름 (assistant 답변은 JSON 객체라 중간에 자르면 깨짐)
+        messages.append({"role": role, "content": content if role == "assistant" else content[:MAX_MESSAGE_CHARS]})
+
+    # 프롬프트 크기 확인: 고정 프롬프트 + 대화 + 질문을 빼고 남는 만큼만 검색 결과를 넣음
+    # 검색 결과는 유사도 순이라 넘치면 뒤(덜 비슷한 이벤트)부터 뺌
+    budget = MAX_PROMPT_CHARS - sum(len(m["content"]) for m in messages) - len(message)
+    retrieved = []
+    for idx in similar_indices:
+        budget -= len(event_compact_json[idx]) + 1
+        if budget < 0:
+            break
+        retrieved.append(event_compact_json[idx])
+
+    # 요청마다 바뀌는 오늘 날짜와 검색된 이벤트는 별도 메시지로
+    if retrieved:
+        # compact_events 구성 (시작할 때 만들어둔 이벤트별 JSON 문자열을 이어붙이기만 함)
+        compact_events_json = "[" + ",".join(retrieved) + "]"
+        context_prompt = f"Today's date: {get_today_str()}\nRetrieved events (via semantic search): {compact_events_json}\n"
+    else:
+        # 관련 있는 이벤트가 없으면 이벤트 목록 대신 한 줄 안내만 (입력 토큰 절약)
+        context_prompt = f"Today's date: {get_today_str()}\nRetrieved events: none (no strong match - answer as small talk, recommended_event must be [])\n"
+    messages.append({"role": "system", "content": context_prompt})
     messages.append({"role": "user", "content": str(message)})
 
     try:
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.5, #창의성 조절
-        )
+        async with openai_semaphore, chat_rate_limiter:
+            response = await openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.5, #창의성 조절
+            )
         reply = response.choices[0].message.content.strip()
 
         # 히스토리 업데이트
         if session_id:
             history.append({"role": "user", "content": message})
             history.append({"role": "assistant", "content": reply})
-            if len(history) > 16:
-                conversation_memory[session_id] = history[-16:]
 
         # JSON 파싱
         try:
-            json_reply = json.loads(reply)
-            return {"response": json_reply["response"]}
+            json_reply = orjson.loads(reply)
+            result = {"response": json_reply["response"]}
+            if cacheable:
+                store_cached_response(query_vector, result)
+            return result
         except Exception:
             return {"response": {
                 "intent": "other",
@@ -549,15 +1118,20 @@ async def api_chat(request: Request):
     return await chatbot(raw_message, chat_history)
 
 
+# 이벤트 목록은 시작할 때 한 번 직렬화해둔 바이트를 그대로 보냄 (요청마다 직렬화 안 함)
 @app.get("/events")
-async def api_events():
-    return {"events": events_data}
+async def api_events(request: Request):
+    if events_response is None: #시작 전이면 지금 만듦
+        refresh_events_responses()
+    return cached_json_response(request, events_response)
 
 
 @app.get("/events_en")
-async def api_events_en():
+async def api_events_en(request: Request):
     """영어 이벤트 반환"""
-    return {"events": events_data_en if events_data_en else events_data}
+    if events_en_response is None:
+        refresh_events_responses()
+    return cached_json_response(request, events_en_response)
 
 
 # =========================